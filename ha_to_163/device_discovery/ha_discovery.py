@@ -1,8 +1,12 @@
 import requests
 import re
+import sys
+import functools
+import json
+import codecs
 import logging
-import time
-from typing import Dict
+from collections import defaultdict, namedtuple
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple
 from .base_discovery import BaseDiscovery
 
 # 扩展属性映射（物模型属性名 ← HA实体属性名/关键词）
@@ -89,7 +93,6 @@ PROPERTY_MAPPING = {
     # ========== 开关状态 ==========
     "state": "state",
     "switch": "state",
-    "power": "state",
     
     # ========== 电力参数 ==========
     "voltage": "voltage",
@@ -104,54 +107,305 @@ PROPERTY_MAPPING = {
     "freq": "frequency",
 }
 
+_logger = logging.getLogger("ha_discovery")
+
+# 关键词正则由完整映射表构成（按长度降序，保证 battery_level 优先于 battery）；
+# 命中的关键词映射到设备不支持的属性时排除该实体，而不是继续寻找较短的受支持关键词
+_KEYWORD_ALTERNATION = "|".join(re.escape(key) for key in sorted(PROPERTY_MAPPING, key=len, reverse=True))
+# 实体ID后缀：关键词需由"_"分隔的完整词组成（如 co2_density_p_3_8 → co2_density_p）
+_ENTITY_KEYWORD_RE = re.compile(f"(?:^|_)({_KEYWORD_ALTERNATION})(?=_|$)")
+# friendly_name：子串匹配
+_FRIENDLY_KEYWORD_RE = re.compile(_KEYWORD_ALTERNATION)
+
+
+# 二进制传感器按device_class映射（门磁、烟雾等开关量）
+BINARY_SENSOR_MAPPING = {
+    "door": "switch",
+    "window": "switch",
+    "opening": "switch",
+    "smoke": "smoke",
+}
+
+# 电气类设备（开关/插座/断路器），其余类型按环境传感器处理
+ELECTRIC_DEVICE_TYPES = ("switch", "socket", "breaker")
+
+# 设备发现只关心的实体域，同时排除单位类实体（如 temperature_unit, tvoc_unit_p_3_2 等）
+# 这些实体返回的是单位字符串（如 "CelUnit", "PPB"），不是数值
+_ACCEPT_RE = re.compile(r"(sensor|binary_sensor|switch)\.((?!.*_unit(?:_|$)).+)")
+
+# 实体精简记录：只保留匹配所需字段（core为去掉域名的实体ID，属性已转小写）
+_Entity = namedtuple("_Entity", "entity_id domain core device_class friendly_name")
+
+
+def _iter_json_array(chunks: Iterable[bytes]) -> Iterator[dict]:
+    """增量解析JSON对象数组，边下载边逐个产出元素（无需先加载整个响应）"""
+    decoder = json.JSONDecoder()
+    utf8 = codecs.getincrementaldecoder("utf-8")()
+    buf = ""
+    pos = 0
+    started = False
+    for chunk in chunks:
+        buf = buf[pos:] + utf8.decode(chunk)
+        pos = 0
+        while True:
+            while pos < len(buf) and buf[pos] in " \t\r\n,":
+                pos += 1
+            if pos >= len(buf):
+                break
+            if not started:
+                if buf[pos] != "[":
+                    raise ValueError("HA返回的数据不是JSON数组")
+                started = True
+                pos += 1
+                continue
+            if buf[pos] == "]":
+                return
+            try:
+                item, pos = decoder.raw_decode(buf, pos)
+            except json.JSONDecodeError:
+                break  # 元素不完整，等待后续数据
+            yield item
+    raise ValueError("HA返回的JSON数组不完整")
+
+
+# 设备开关实体的后缀关键词（如 switch.plug_01_switch_p_2_1、switch.plug_01_on_p_2_1）
+_SWITCH_SUFFIX_RE = re.compile(r"(?:^|_)(?:switch|on|state)(?=_|$)")
+
+
+def switch_state_rank(entity_suffix: str, anchored: bool) -> int:
+    """开关实体作为设备开关状态的优先级（越小越优先），设备发现与开关控制共用
+    
+    0：与设备前缀完全一致（switch.<前缀>）
+    1：以前缀开头且后缀含开关关键词（switch/on/state）
+    2：其余包含前缀的开关（宽松匹配，兼容旧配置）
+    """
+    if anchored:
+        if not entity_suffix:
+            return 0
+        if _SWITCH_SUFFIX_RE.search(entity_suffix):
+            return 1
+    return 2
+
+
+# 属性解析结果缓存上限（跨发现周期复用，实体不变时直接命中）
+_RESOLVE_CACHE_SIZE = 4096
+
+
+@functools.lru_cache(maxsize=_RESOLVE_CACHE_SIZE)
+def _resolve_property(supported: frozenset, domain: str, device_class: str,
+                      friendly_name: str, entity_suffix: str) -> Optional[str]:
+    """根据实体域、device_class、实体ID后缀和friendly_name解析属性（按完整映射表解析，不支持的属性返回None）"""
+    # 二进制传感器只按device_class识别开关量
+    if domain == "binary_sensor":
+        return BINARY_SENSOR_MAPPING.get(device_class)
+    
+    # 开关实体只用于设备开关状态，多个候选按switch_state_rank择优
+    if domain == "switch":
+        return "state"
+    
+    if not entity_suffix:
+        return None
+    
+    # 方式1：通过device_class匹配（最可靠）
+    property_name = PROPERTY_MAPPING.get(device_class)
+    if property_name:
+        _logger.debug("通过device_class匹配: %s → %s", device_class, property_name)
+    
+    # 方式2：通过实体ID中的关键词匹配（最靠前的完整词组，同位置优先最长关键词）
+    if not property_name:
+        match = _ENTITY_KEYWORD_RE.search(entity_suffix)
+        if match:
+            property_name = PROPERTY_MAPPING[match.group(1)]
+            _logger.debug("通过实体ID关键词匹配: %s → %s", match.group(1), property_name)
+    
+    # 方式3：通过friendly_name匹配
+    if not property_name:
+        match = _FRIENDLY_KEYWORD_RE.search(friendly_name)
+        if match:
+            property_name = PROPERTY_MAPPING[match.group(0)]
+            _logger.debug("通过friendly_name匹配: %s → %s", match.group(0), property_name)
+    
+    # 首个命中指向设备不支持的属性时排除该实体，
+    # 避免 battery_voltage（device_class=voltage）、battery_temperature 之类被误判为 battery/temp
+    if property_name and property_name not in supported:
+        _logger.debug("解析结果 %s 不在设备支持列表中，忽略该实体", property_name)
+        return None
+    return property_name
+
+
+class _PrefixTrie:
+    """字符前缀树：一次遍历实体ID找出所有以其为前缀的设备（最长前缀优先）
+    
+    另提供任意位置匹配（search），用于前缀不在实体ID开头的宽松匹配
+    """
+
+    def __init__(self):
+        self._root = {}
+        self._prefixes = {}  # 前缀 → 设备列表
+        self._pattern = None  # 所有前缀的交替正则（首次search时构建）
+
+    def add(self, prefix: str, value):
+        node = self._root
+        for ch in prefix:
+            node = node.setdefault(ch, {})
+        # 使用None作为终止标记，同一前缀可对应多个设备
+        node.setdefault(None, []).append(value)
+        self._prefixes.setdefault(prefix, []).append(value)
+        self._pattern = None
+
+    def match(self, text: str) -> List[Tuple[int, object]]:
+        """返回 [(前缀结束位置, 值)]，按前缀长度降序排列"""
+        hits = [(0, value) for value in self._root.get(None, ())]
+        node = self._root
+        for depth, ch in enumerate(text, 1):
+            node = node.get(ch)
+            if node is None:
+                break
+            hits.extend((depth, value) for value in node.get(None, ()))
+        hits.reverse()
+        return hits
+
+    def search(self, text: str) -> List[Tuple[int, object]]:
+        """查找text中任意位置最先出现的前缀（同位置优先最长），返回 [(前缀结束位置, 值)]"""
+        if self._pattern is None:
+            prefixes = sorted((p for p in self._prefixes if p), key=len, reverse=True)
+            if not prefixes:
+                return []
+            self._pattern = re.compile("|".join(map(re.escape, prefixes)))
+        match = self._pattern.search(text)
+        if not match:
+            return []
+        return [(match.end(), value) for value in self._prefixes[match.group(0)]]
+
 
 class HADiscovery(BaseDiscovery):
     """基于HA实体的设备发现"""
     
-    def __init__(self, config, ha_headers):
+    def __init__(self, config, ha_headers, session: Optional[requests.Session] = None):
         super().__init__(config, "ha_discovery")
         self.ha_url = config.get("ha_url")
         self.ha_headers = ha_headers
         self.entities = []  # 存储HA中的实体列表
+        self._debug = False  # 每次discover()开始时刷新，避免热循环中反复判断日志级别
         self.sub_devices = [d for d in config.get("sub_devices", []) if d.get("enabled", True)]
+        
+        # 设备前缀按类别（环境传感器/电气设备）在构造时建好前缀树，各发现周期复用
+        # 前缀按实体ID去掉域名后的部分锚定匹配（兼容配置中带"sensor."的写法）
+        env_trie = _PrefixTrie()
+        elec_trie = _PrefixTrie()
+        for device in self.sub_devices:
+            prefix = device["ha_entity_prefix"]
+            if "." in prefix:
+                prefix = prefix.split(".", 1)[1]
+            trie = elec_trie if device["type"] in ELECTRIC_DEVICE_TYPES else env_trie
+            trie.add(prefix, device["id"])
+        
+        # 每个设备的支持属性集合（设备配置固定，构造时预先计算）
+        # 配置中的属性名驻留（intern）后，与映射表中的属性名比较可直接按对象身份命中
+        self._device_supported = {}
+        self._device_factors = {}  # 转换系数只解析一次，推送时直接使用
+        for device in self.sub_devices:
+            supported = frozenset(sys.intern(prop) for prop in device.get("supported_properties", ()))
+            self._device_supported[device["id"]] = supported
+            self._device_factors[device["id"]] = self._parse_conversion_factors(
+                device.get("conversion_factors", "")
+            )
+        # 按实体域分派：sensor实体先查电气设备再查环境传感器，每个设备最多检查一次
+        self._domain_tries = {
+            "sensor": (elec_trie, env_trie),
+            "binary_sensor": (env_trie,),
+            "switch": (elec_trie,),
+        }
+        
+        # 复用HTTP会话（重试策略由调用方在会话上配置），并缓存上次的实体列表（支持条件请求和失败时使用旧数据）
+        self._etag = None
+        if session is None:
+            session = requests.Session()
+            session.headers.update(ha_headers)
+        self.session = session
     
-    def load_ha_entities(self) -> bool:
-        """从HA API加载实体列表"""
+    def _parse_conversion_factors(self, factors_str: str) -> dict:
+        """解析转换系数（字符串转字典）"""
+        if not factors_str:
+            return {}
         try:
-            self.logger.info(f"从HA获取实体列表: {self.ha_url}/api/states")
-            resp = None
-            retry_attempts = self.config.get("retry_attempts", 5)
-            retry_delay = self.config.get("retry_delay", 3)
-            
-            # 带重试的API调用
-            for attempt in range(retry_attempts):
-                try:
-                    resp = requests.get(
-                        f"{self.ha_url}/api/states",
-                        headers=self.ha_headers,
-                        timeout=10
+            return json.loads(factors_str)
+        except json.JSONDecodeError:
+            self.logger.error(f"转换系数格式错误: {factors_str}，将使用默认系数1.0")
+            return {}
+    
+    def load_ha_entities(self, projection: Optional[Tuple[int, List[_Entity]]] = None,
+                         etag: Optional[str] = None) -> bool:
+        """从HA API加载实体列表；传入已投影的状态快照（project_entities的结果）时直接使用，不再请求HA"""
+        try:
+            if projection is not None:
+                self.logger.info("使用已获取的HA状态快照进行设备发现，跳过实体列表请求")
+                total, self.entities = projection
+                self._etag = etag  # 快照对应的ETag，后续条件请求仍可命中304
+            else:
+                self.logger.info(f"从HA获取实体列表: {self.ha_url}/api/states")
+                # 条件请求：实体列表未变化时HA返回304，无需重新下载和解析
+                headers = {"If-None-Match": self._etag} if self._etag and self.entities else None
+                with self.session.get(
+                    f"{self.ha_url}/api/states",
+                    headers=headers,
+                    timeout=10,
+                    stream=True
+                ) as resp:
+                    if resp.status_code == 304:
+                        self.logger.info(f"HA实体列表未变化，沿用缓存的 {len(self.entities)} 个实体")
+                        return True
+                    
+                    if resp.status_code != 200:
+                        self.logger.error(f"HA实体获取失败，状态码: {resp.status_code}")
+                        return self._use_cached_entities()
+                    
+                    # 流式解析
+                    total, self.entities = self.project_entities(
+                        _iter_json_array(resp.iter_content(chunk_size=65536))
                     )
-                    resp.raise_for_status()
-                    break
-                except Exception as e:
-                    self.logger.warning(f"获取HA实体尝试 {attempt+1}/{retry_attempts} 失败: {e}")
-                    if attempt < retry_attempts - 1:
-                        time.sleep(retry_delay)
+                    self._etag = resp.headers.get("ETag")
+            self.logger.info(f"HA共返回 {total} 个实体，其中 {len(self.entities)} 个参与匹配")
             
-            if not resp or resp.status_code != 200:
-                self.logger.error(f"HA实体获取失败，状态码: {resp.status_code if resp else '无响应'}")
-                return False
-            
-            self.entities = resp.json()
-            self.logger.info(f"HA共返回 {len(self.entities)} 个实体")
-            
-            # 输出传感器实体列表（便于排查）
-            sensor_entities = [e.get('entity_id') for e in self.entities if e.get('entity_id', '').startswith('sensor.')]
-            self.logger.debug(f"HA中的传感器实体列表: {sensor_entities}")
+            # 按实体域输出实体列表（便于排查，仅调试模式下一次遍历分桶构建）
+            if self._debug:
+                buckets = defaultdict(list)
+                for e in self.entities:
+                    buckets[e.domain].append(e.entity_id)
+                for domain in ("sensor", "binary_sensor", "switch"):
+                    self.logger.debug("HA中的 %s 实体列表: %s", domain, buckets[domain])
             return True
         except Exception as e:
             self.logger.error(f"加载HA实体失败: {e}")
+            return self._use_cached_entities()
+    
+    @staticmethod
+    def project_entities(states: Iterable[dict]) -> Tuple[int, List[_Entity]]:
+        """只保留关心域的实体及匹配所需字段，返回（HA实体总数, 实体列表）"""
+        total = 0
+        entities = []
+        for state in states:
+            total += 1
+            entity_id = state.get("entity_id", "")
+            accepted = _ACCEPT_RE.fullmatch(entity_id)
+            if not accepted:
+                continue
+            attributes = state.get("attributes") or {}
+            entities.append(_Entity(
+                entity_id,
+                accepted.group(1),
+                accepted.group(2),
+                (attributes.get("device_class") or "").lower(),
+                (attributes.get("friendly_name") or "").lower()
+            ))
+        return total, entities
+    
+    def _use_cached_entities(self) -> bool:
+        """HA暂时不可用时沿用上次成功获取的实体列表"""
+        if not self.entities:
             return False
+        self.logger.warning(f"沿用上次获取的 {len(self.entities)} 个实体继续匹配")
+        return True
     
     def match_entities_to_devices(self) -> Dict:
         """将HA实体匹配到子设备"""
@@ -162,97 +416,88 @@ class HADiscovery(BaseDiscovery):
             matched_devices[device_id] = {
                 "config": device,
                 "sensors": {},  # 存储 {属性: 实体ID} 映射
+                "supported": self._device_supported[device_id],  # O(1)成员判断
+                "factors": self._device_factors[device_id],  # 已解析的转换系数 {属性: 系数}
                 "last_data": None
             }
-            self.logger.info(f"开始匹配设备: {device_id}（前缀: {device['ha_entity_prefix']}）")
+            self.logger.info("开始匹配设备: %s（前缀: %s）", device_id, device["ha_entity_prefix"])
+        
+        # 所有设备的待匹配属性总数，全部匹配后提前结束遍历
+        remaining = sum(len(device_data["supported"]) for device_data in matched_devices.values())
+        # 非精确匹配的开关实体暂存为备选 {设备ID: (优先级, 实体ID)}，遍历结束后仍无精确匹配时采用
+        fallback_switches = {}
         
-        # 遍历HA实体进行匹配
+        # 遍历HA实体，按实体域分派到对应类别设备的前缀树
         for entity in self.entities:
-            entity_id = entity.get("entity_id", "")
-            if not entity_id.startswith("sensor."):
-                continue  # 只处理传感器实体
+            if remaining == 0:
+                self.logger.debug("所有设备属性均已匹配，提前结束实体遍历")
+                break
             
-            # 【重要】排除单位类实体（如 temperature_unit, tvoc_unit 等）
-            # 这些实体返回的是单位字符串（如 "CelUnit", "PPB"），不是数值
-            if "_unit_" in entity_id or entity_id.endswith("_unit"):
-                self.logger.debug(f"跳过单位实体: {entity_id}")
-                continue
+            # 通过前缀树直接定位候选设备（最长前缀优先），无需遍历所有设备
+            tries = self._domain_tries[entity.domain]
+            candidates = [hit for trie in tries for hit in trie.match(entity.core)]
+            anchored = bool(candidates)
+            if not candidates:
+                # 宽松匹配：前缀出现在实体ID中间（解决命名偏差），由正则一次扫描完成
+                candidates = [hit for trie in tries for hit in trie.search(entity.core)]
+                if not candidates:
+                    continue
             
-            # 提取实体属性（用于多维度匹配）
-            attributes = entity.get("attributes", {})
-            device_class = attributes.get("device_class", "").lower()
-            friendly_name = attributes.get("friendly_name", "").lower()
-            self.logger.debug(f"处理实体: {entity_id} (device_class: {device_class}, friendly_name: {friendly_name})")
+            entity_id = entity.entity_id
+            if self._debug:
+                self.logger.debug("处理实体: %s (device_class: %s, friendly_name: %s)",
+                                  entity_id, entity.device_class, entity.friendly_name)
             
-            # 匹配到对应的子设备
-            for device_id, device_data in matched_devices.items():
-                device = device_data["config"]
-                prefix = device["ha_entity_prefix"]
+            for prefix_end, device_id in candidates:
+                device_data = matched_devices[device_id]
+                # 设备支持的属性已全部匹配，无需再解析该实体
+                if len(device_data["sensors"]) == len(device_data["supported"]):
+                    continue
+                
+                # 提取实体类型（如"sensor.hz2_01_temperature_p_3_7" → "temperature_p_3_7"）
+                entity_suffix = entity.core[prefix_end:].strip('_')
+                property_name = _resolve_property(
+                    device_data["supported"], entity.domain, entity.device_class,
+                    entity.friendly_name, entity_suffix
+                )
                 
-                # 宽松匹配：前缀包含在实体ID中（解决命名偏差）
-                if prefix in entity_id:
-                    # 提取实体类型（如"sensor.hz2_01_temperature_p_3_7" → "temperature_p_3_7"）
-                    entity_suffix = entity_id.replace(f"sensor.{prefix}", "").strip('_')
-                    entity_type_parts = entity_suffix.split('_')
-                    if not entity_suffix:
+                # 验证属性是否在设备支持列表中（同一属性保留最先匹配的实体）
+                if property_name not in device_data["supported"] or property_name in device_data["sensors"]:
+                    continue
+                if entity.domain == "switch":
+                    rank = switch_state_rank(entity_suffix, anchored)
+                    if rank:
+                        # 同优先级保留最先出现的实体
+                        best = fallback_switches.get(device_id)
+                        if best is None or rank < best[0]:
+                            fallback_switches[device_id] = (rank, entity_id)
                         continue
-                    
-                    # 多维度匹配属性
-                    property_name = None
-                    
-                    # 方式1：通过device_class匹配（最可靠）
-                    if device_class in PROPERTY_MAPPING:
-                        property_name = PROPERTY_MAPPING[device_class]
-                        self.logger.debug(f"通过device_class匹配: {device_class} → {property_name}")
-                    
-                    # 方式2：通过组合关键词匹配（如 "relative_humidity", "co2_density"）
-                    if not property_name:
-                        # 尝试匹配多词组合（优先级更高）
-                        for i in range(len(entity_type_parts)):
-                            for j in range(i + 1, min(i + 4, len(entity_type_parts) + 1)):
-                                combo = '_'.join(entity_type_parts[i:j])
-                                if combo in PROPERTY_MAPPING:
-                                    property_name = PROPERTY_MAPPING[combo]
-                                    self.logger.debug(f"通过组合关键词匹配: {combo} → {property_name}")
-                                    break
-                            if property_name:
-                                break
-                    
-                    # 方式3：通过单个实体ID部分匹配
-                    if not property_name:
-                        for part in entity_type_parts:
-                            if part in PROPERTY_MAPPING:
-                                property_name = PROPERTY_MAPPING[part]
-                                self.logger.debug(f"通过实体ID部分匹配: {part} → {property_name}")
-                                break
-                    
-                    # 方式4：通过friendly_name匹配
-                    if not property_name:
-                        for key in PROPERTY_MAPPING:
-                            if key in friendly_name:
-                                property_name = PROPERTY_MAPPING[key]
-                                self.logger.debug(f"通过friendly_name匹配: {key} → {property_name}")
-                                break
-                    
-                    # 验证属性是否在设备支持列表中
-                    if property_name and property_name in device["supported_properties"]:
-                        device_data["sensors"][property_name] = entity_id
-                        self.logger.info(f"匹配成功: {entity_id} → {property_name}（设备: {device_id}）")
-                        break  # 已匹配到设备，跳出循环
+                device_data["sensors"][property_name] = entity_id
+                remaining -= 1
+                self.logger.info("匹配成功: %s → %s（设备: %s）", entity_id, property_name, device_id)
+                break  # 已匹配到设备，跳出循环
+        
+        # 没有与前缀完全一致的开关实体时，采用优先级最高的备选开关
+        for device_id, (rank, entity_id) in fallback_switches.items():
+            sensors = matched_devices[device_id]["sensors"]
+            if "state" not in sensors:
+                sensors["state"] = entity_id
+                self.logger.info("匹配成功: %s → state（设备: %s，备选优先级 %d）", entity_id, device_id, rank)
         
         # 输出匹配结果
         for device_id, device_data in matched_devices.items():
-            sensors = {k: v for k, v in device_data["sensors"].items()}
-            self.logger.info(f"设备 {device_id} 匹配结果: {sensors}")
+            self.logger.info("设备 %s 匹配结果: %s", device_id, device_data["sensors"])
         
         return matched_devices
     
-    def discover(self) -> Dict:
-        """执行发现流程（主入口）"""
+    def discover(self, projection: Optional[Tuple[int, List[_Entity]]] = None,
+                 etag: Optional[str] = None) -> Dict:
+        """执行发现流程（主入口）；projection为调用方已获取快照的投影结果，可省去一次请求"""
         self.logger.info("开始基于HA实体的设备发现...")
+        self._debug = self.logger.isEnabledFor(logging.DEBUG)
         
         # 第一步：加载HA实体
-        if not self.load_ha_entities():
+        if not self.load_ha_entities(projection, etag):
             return {}
         
         # 第二步：匹配实体到设备
@@ -1,14 +1,40 @@
 import logging
-import time
+import hashlib
 import json
+import re
+import time
 import signal
 import requests
-from concurrent.futures import ThreadPoolExecutor, as_completed
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from typing import Optional
+from concurrent.futures import ThreadPoolExecutor, as_completed, TimeoutError as FuturesTimeoutError
 import threading
 from utils.config_loader import ConfigLoader
 from utils.mqtt_client import MQTTClient
+from utils.ha_websocket import HAStateStream
 from device_discovery.ha_discovery import HADiscovery
 
+# 可选使用orjson解析状态快照（更快），未安装时使用标准库json
+try:
+    from orjson import loads as _json_loads
+except ImportError:
+    _json_loads = json.loads
+
+# 从实体状态中提取数值（模块加载时编译一次）
+_NUM_RE = re.compile(r'[-+]?\d*\.\d+|\d+')
+# 表示实体暂无有效数据的状态值
+_UNAVAILABLE_STATES = frozenset(("unknown", "unavailable", ""))
+
+# 各属性推送值保留的小数位数（0表示取整，如电量、充电状态）
+_ROUND_DP = {
+    "current": 3, "active_power": 3,
+    "voltage": 1, "temp": 1, "hum": 1, "frequency": 1,
+    "co2": 1, "pm2_5": 1, "pm10": 1, "tvoc": 1, "noise": 1,
+    "energy": 4,
+    "battery": 0, "charging": 0,
+}
+
 
 class HAto163Gateway:
     def __init__(self):
@@ -24,14 +50,54 @@ class HAto163Gateway:
         }
 
         # 3. 创建HTTP会话（复用连接）
+        # 就绪探测、状态快照和数据推送不在连接层重试：失败由退避等待或下一个推送周期处理，
+        # 避免HA启动中或返回5xx时阻塞等待、延迟响应停止信号
         self.ha_session = requests.Session()
         self.ha_session.headers.update(self.ha_headers)
-
-        # 4. 设备与MQTT客户端初始化（修复：MQTTClient只传config参数）
+        # 连接池大小与推送线程数一致，避免并发推送时排队或丢弃连接
+        adapter = HTTPAdapter(pool_connections=16, pool_maxsize=16)
+        self.ha_session.mount("http://", adapter)
+        self.ha_session.mount("https://", adapter)
+
+        # 设备发现的实体列表请求单独使用带重试的会话（在后台线程执行，按retry_attempts/retry_delay指数退避，仅重试GET）
+        retry_attempts = self.config.get("retry_attempts", 5)
+        retry_delay = self.config.get("retry_delay", 3)
+        self.discovery_session = requests.Session()
+        self.discovery_session.headers.update(self.ha_headers)
+        discovery_adapter = HTTPAdapter(max_retries=Retry(
+            total=max(retry_attempts - 1, 0),
+            backoff_factor=retry_delay / 2,
+            status_forcelist=(500, 502, 503, 504),
+            allowed_methods=frozenset(["GET"]),
+            raise_on_status=False
+        ))
+        self.discovery_session.mount("http://", discovery_adapter)
+        self.discovery_session.mount("https://", discovery_adapter)
+
+        # 4. 设备与MQTT客户端初始化（控制请求复用上面的会话连接池）
         self.matched_devices = {}
-        self.mqtt_client = MQTTClient(self.config)  # 移除多余的ha_session参数
+        self.mqtt_client = MQTTClient(self.config, session=self.ha_session)
+        # 设备发现实例常驻，跨周期复用HTTP会话和实体缓存
+        self.discovery = HADiscovery(self.config, self.ha_headers, session=self.discovery_session)
+        # 实体状态优先来自WebSocket推送的本地缓存，不可用时退回每周期轮询快照
+        self.state_stream = (
+            HAStateStream(self.config["ha_url"], self.config["ha_token"])
+            if self.config.get("use_websocket", False) else None
+        )
         self.running = True
+        self._stop_event = threading.Event()  # 停止信号，用于唤醒主循环的等待
         self.executor = None  # 线程池实例
+        self._discovery_thread = None  # 定时发现在后台线程执行，不阻塞数据推送
+        # 数据未变化时跳过上报，但最长每隔该时间（秒）强制上报一次；0表示每个周期都上报
+        self.max_publish_interval = self.config.get("max_publish_interval", 600)
+        self._last_published = {}  # {设备ID: (上次上报数据的哈希, 上报时间)}
+        # 状态快照缓存（条件请求/内容摘要未变化时复用）
+        self._states_cache = {}
+        self._states_etag = None
+        self._states_digest = None
+        # 最近一次快照的实体投影（获取时间, HADiscovery.project_entities结果），足够新时设备发现直接复用
+        # 只保留匹配所需字段，不常驻完整的/api/states解析结果
+        self._latest_snapshot = (0.0, None)
 
         # 注册退出信号处理
         signal.signal(signal.SIGINT, self._stop)
@@ -41,12 +107,17 @@ class HAto163Gateway:
         """处理程序退出，释放资源"""
         self.logger.info("收到停止信号，正在安全退出...")
         self.running = False
+        self._stop_event.set()
         
         # 关闭线程池
         if self.executor:
             self.executor.shutdown(wait=False, cancel_futures=True)
             self.logger.info("线程池已关闭")
         
+        # 停止WebSocket状态订阅
+        if self.state_stream:
+            self.state_stream.stop()
+        
         # 断开MQTT连接
         if hasattr(self, 'mqtt_client') and self.mqtt_client:
             self.mqtt_client.disconnect()
@@ -55,15 +126,19 @@ class HAto163Gateway:
         # 关闭HTTP会话
         if hasattr(self, 'ha_session'):
             self.ha_session.close()
+            self.discovery_session.close()
             self.logger.info("HTTP会话已关闭")
 
     def _wait_for_ha_ready(self) -> bool:
         """等待Home Assistant服务就绪"""
         timeout = self.config.get("entity_ready_timeout", 600)
-        start_time = time.time()
+        start_time = time.monotonic()
         self.logger.info(f"等待HA就绪（超时时间: {timeout}秒）")
 
-        while time.time() - start_time < timeout:
+        delay = 1.0  # 重试间隔从1秒开始指数增长，最长30秒
+        attempts = 0
+        while time.monotonic() - start_time < timeout:
+            attempts += 1
             try:
                 resp = self.ha_session.get(
                     f"{self.config['ha_url']}/api/",
@@ -72,10 +147,19 @@ class HAto163Gateway:
                 if resp.status_code == 200:
                     self.logger.info("Home Assistant已就绪")
                     return True
+                error = f"状态码: {resp.status_code}"
             except requests.exceptions.RequestException as e:
-                self.logger.warning(f"HA未就绪: {str(e)}，将重试")
+                error = str(e)
+            
+            # 首次及之后每5次失败记录一次，HA启动较慢时避免日志刷屏
+            if attempts == 1 or attempts % 5 == 0:
+                self.logger.warning(f"HA未就绪（第 {attempts} 次检查）: {error}，将重试")
             
-            time.sleep(10)  # 间隔10秒重试
+            # 收到停止信号时立即结束等待
+            remaining = timeout - (time.monotonic() - start_time)
+            if self._stop_event.wait(max(0, min(delay, remaining))):
+                return False
+            delay = min(delay * 1.5, 30)
 
         self.logger.error(f"HA超时未就绪（超过{timeout}秒）")
         return False
@@ -83,12 +167,11 @@ class HAto163Gateway:
     def _discover_devices(self) -> bool:
         """执行设备发现，匹配HA实体与子设备"""
         try:
-            # HADiscovery只需要config和ha_headers两个参数
-            discovery = HADiscovery(
-                self.config,
-                self.ha_headers
-            )
-            new_matched_devices = discovery.discover()
+            # 推送周期内刚获取过完整快照时直接复用，省去一次实体列表请求
+            snapshot_at, projection = self._latest_snapshot
+            if time.monotonic() - snapshot_at > self.config.get("wy_push_interval", 60):
+                projection = None
+            new_matched_devices = self.discovery.discover(projection, etag=self._states_etag)
 
             # 记录新增实体
             for device_id, new_data in new_matched_devices.items():
@@ -101,152 +184,185 @@ class HAto163Gateway:
                     self.logger.info(f"设备 {device_id} 新增匹配实体: {added_sensors}")
 
             self.matched_devices = new_matched_devices
+            # WebSocket只订阅匹配到的实体，重新发现后同步订阅列表
+            if self.state_stream:
+                self.state_stream.set_entities(self._required_entities(self.matched_devices))
             return len(self.matched_devices) > 0
 
         except Exception as e:
             self.logger.error(f"设备发现失败: {str(e)}")
             return False
 
-    def _get_entity_value(self, entity_id: str, device_type: str) -> float or int or None:
-        """获取HA实体值（带超时控制）"""
+    def _snapshot_states(self) -> dict:
+        """一次性获取HA全部实体状态快照（每个推送周期只请求一次）
+        HA返回304或响应内容与上次相同时直接复用上次解析的结果，返回副本供调用方修改
+        """
         try:
-            single_entity_timeout = self.config.get("single_entity_timeout", 30)
-            start_time = time.time()
-            
-            while time.time() - start_time < single_entity_timeout:
-                try:
-                    resp = self.ha_session.get(
-                        f"{self.config['ha_url']}/api/states/{entity_id}",
-                        timeout=5  # 单次请求超时
-                    )
-                    
-                    if resp.status_code == 200:
-                        state = resp.json().get("state")
-                        if state in ("unknown", "unavailable", ""):
-                            time.sleep(2)
-                            continue
-
-                        # 处理开关类设备状态
-                        if device_type in ("switch", "socket", "breaker"):
-                            if state == "on":
-                                return 1
-                            elif state == "off":
-                                return 0
-                            elif state == "trip" and device_type == "breaker":
-                                return 2
-
-                        # 处理二进制传感器（如门磁）
-                        if device_type == "sensor" and entity_id.startswith("binary_sensor."):
-                            return 1 if state == "on" else 0
-
-                        # 提取数值型状态
-                        import re
-                        match = re.search(r'[-+]?\d*\.\d+|\d+', state)
-                        if match:
-                            return float(match.group())
-
-                        self.logger.warning(f"实体 {entity_id} 状态无法转换为数值: {state}")
-                        return None
-
-                except requests.exceptions.RequestException as e:
-                    self.logger.warning(f"获取实体 {entity_id} 临时失败: {str(e)}")
-                    time.sleep(2)
-
-            self.logger.error(f"实体 {entity_id} 超时未就绪（{single_entity_timeout}秒）")
-            return None
-
+            headers = {"If-None-Match": self._states_etag} if self._states_etag and self._states_cache else None
+            resp = self.ha_session.get(
+                f"{self.config['ha_url']}/api/states",
+                headers=headers,
+                timeout=10
+            )
+            if resp.status_code == 304:
+                self._latest_snapshot = (time.monotonic(), self._latest_snapshot[1])
+                return dict(self._states_cache)
+            if resp.status_code != 200:
+                self.logger.error(f"获取HA状态快照失败，状态码: {resp.status_code}")
+                return {}
+
+            # HA通常不返回ETag，按响应内容摘要判断是否变化，未变化时跳过JSON解析
+            body = resp.content
+            digest = hashlib.blake2b(body, digest_size=16).digest()
+            if digest != self._states_digest or not self._states_cache:
+                raw_states = _json_loads(body)
+                self._states_cache = {e["entity_id"]: e.get("state") for e in raw_states}
+                self._states_digest = digest
+                self._latest_snapshot = (time.monotonic(), HADiscovery.project_entities(raw_states))
+            else:
+                self._latest_snapshot = (time.monotonic(), self._latest_snapshot[1])
+            self._states_etag = resp.headers.get("ETag")
+            return dict(self._states_cache)
         except Exception as e:
-            self.logger.error(f"获取实体 {entity_id} 失败: {str(e)}")
-            return None
-
-    def _parse_conversion_factors(self, factors_str: str) -> dict:
-        """解析转换系数（字符串转字典）"""
-        if not factors_str:
+            self.logger.error(f"获取HA状态快照失败: {str(e)}")
             return {}
+
+    def _current_states(self) -> dict:
+        """获取当前实体状态：WebSocket缓存就绪时直接使用，否则拉取一次快照"""
+        if self.state_stream:
+            states = self.state_stream.snapshot()
+            if states:
+                return states
+            self.logger.debug("WebSocket状态缓存未就绪，使用轮询快照")
+        return self._snapshot_states()
+
+    def _required_entities(self, matched_devices: dict) -> set:
+        """汇总所有设备需要读取的实体ID（多个设备共用的实体只计一次）"""
+        return {
+            entity_id
+            for device_data in matched_devices.values()
+            for entity_id in device_data.get("sensors", {}).values()
+        }
+
+    def _wait_for_entities_ready(self) -> bool:
+        """设备发现后一次性等待所有匹配实体就绪（不再逐个实体等待），超时后照常运行"""
+        timeout = self.config.get("single_entity_timeout", 30)
+        required = self._required_entities(self.matched_devices)
+        deadline = time.monotonic() + timeout
+
+        while True:
+            states = self._current_states()
+            pending = [
+                entity_id for entity_id in required
+                if states.get(entity_id) is None or states[entity_id] in _UNAVAILABLE_STATES
+            ]
+            if not pending:
+                self.logger.info(f"全部 {len(required)} 个匹配实体已就绪")
+                return True
+            if time.monotonic() >= deadline:
+                self.logger.warning(f"以下实体 {timeout} 秒内未就绪，将在后续推送周期中继续读取: {sorted(pending)}")
+                return False
+            if self._stop_event.wait(2):
+                return False
+
+    def _fetch_entity_state(self, entity_id: str) -> Optional[str]:
+        """单独获取一个实体的状态（仅用于快照中缺失的实体）"""
         try:
-            return json.loads(factors_str)
-        except json.JSONDecodeError:
-            self.logger.error(f"转换系数格式错误: {factors_str}，将使用默认系数1.0")
-            return {}
+            resp = self.ha_session.get(
+                f"{self.config['ha_url']}/api/states/{entity_id}",
+                timeout=5
+            )
+            if resp.status_code == 200:
+                return resp.json().get("state")
+            self.logger.warning(f"获取实体 {entity_id} 失败，状态码: {resp.status_code}")
+        except Exception as e:
+            self.logger.warning(f"获取实体 {entity_id} 失败: {str(e)}")
+        return None
+
+    def _parse_entity_value(self, state: str, entity_id: str, device_type: str) -> float or int or None:
+        """将实体状态字符串转换为推送值"""
+        if state is None or state in _UNAVAILABLE_STATES:
+            return None
 
-    def _collect_device_data(self, device_id: str) -> dict:
-        """收集设备所有属性数据"""
-        device_data = self.matched_devices[device_id]
+        # 处理开关类设备状态
+        if device_type in ("switch", "socket", "breaker"):
+            if state == "on":
+                return 1
+            elif state == "off":
+                return 0
+            elif state == "trip" and device_type == "breaker":
+                return 2
+
+        # 处理二进制传感器（如门磁）
+        if device_type == "sensor" and entity_id.startswith("binary_sensor."):
+            return 1 if state == "on" else 0
+
+        # 提取数值型状态
+        match = _NUM_RE.search(state)
+        if match:
+            return float(match.group())
+
+        self.logger.warning(f"实体 {entity_id} 状态无法转换为数值: {state}")
+        return None
+
+    def _collect_device_data(self, device_id: str, device_data: dict, states: dict) -> dict:
+        """从状态快照中收集设备所有属性数据"""
         device_config = device_data["config"]
         device_type = device_config["type"]
         # 兼容sensors和entities两种键名
         entities = device_data.get("sensors", device_data.get("entities", {}))
-        
-        # 解析转换系数
-        factors_str = device_config.get("conversion_factors", "")
-        conversion_factors = self._parse_conversion_factors(factors_str)
-
-        # 构建推送 payload
-        payload = {
-            "id": int(time.time() * 1000),
-            "version": "1.0",
-            "params": {}
-        }
+        # 转换系数在设备发现时已解析
+        conversion_factors = device_data.get("factors", {})
 
+        params = {}
         for prop, entity_id in entities.items():
-            value = self._get_entity_value(entity_id, device_type)
+            value = self._parse_entity_value(states.get(entity_id), entity_id, device_type)
             if value is not None:
                 # 状态属性不应用转换系数
                 if prop == "state":
-                    payload["params"][prop] = value
-                    self.logger.info(f"  收集到 {prop} = {value}（实体: {entity_id}）")
+                    params[prop] = value
+                    self.logger.info("  收集到 %s = %s（实体: %s）", prop, value, entity_id)
                 else:
                     # 应用转换系数
                     factor = conversion_factors.get(prop, 1.0)
                     converted_value = value * factor
                     
                     # 根据属性类型保留小数位数
-                    if prop in ("current", "active_power"):
-                        converted_value = round(converted_value, 3)
-                    elif prop in ("voltage", "temp", "hum", "frequency", "co2", "pm2_5", "pm10", "tvoc", "noise"):
-                        converted_value = round(converted_value, 1)
-                    elif prop == "energy":
-                        converted_value = round(converted_value, 4)
-                    elif prop == "battery":
-                        converted_value = int(round(converted_value, 0))  # 电量为整数
-                    elif prop == "charging":
-                        converted_value = int(round(converted_value, 0))  # 充电状态为整数
+                    dp = _ROUND_DP.get(prop)
+                    if dp is not None:
+                        converted_value = round(converted_value, dp) if dp else int(round(converted_value))
                     
-                    payload["params"][prop] = converted_value
+                    params[prop] = converted_value
                     self.logger.info(
-                        f"  收集到 {prop} = {value} * {factor} = {converted_value}（实体: {entity_id}）"
+                        "  收集到 %s = %s * %s = %s（实体: %s）", prop, value, factor, converted_value, entity_id
                     )
             else:
-                self.logger.warning(f"  未获取到 {prop} 数据（实体: {entity_id}）")
+                self.logger.warning("  未获取到 %s 数据（实体: %s）", prop, entity_id)
 
-        return payload
+        # 属性收集完成后一次性构建推送 payload
+        return {"id": int(time.time() * 1000), "version": "1.0", "params": params}
 
-    def _push_device_data(self, device_id: str) -> bool:
-        """推送单设备数据到网易IoT平台"""
-        device_data = self.matched_devices[device_id]
+    def _push_device_data(self, device_id: str, device_data: dict, states: dict) -> bool:
+        """推送单设备数据到网易IoT平台（只读取传入的设备数据，不访问共享的匹配结果）"""
         device_config = device_data["config"]
 
-        payload = self._collect_device_data(device_id)
+        payload = self._collect_device_data(device_id, device_data, states)
         if not payload["params"]:
             self.logger.warning(f"设备 {device_id} 无有效数据，跳过推送")
             return False
         
-        self.logger.info(f"设备 {device_id} 准备推送数据: {payload['params'].keys()}")
-        return self.mqtt_client.publish(device_config, payload)
-
-    def _push_device_with_timeout(self, device_id: str, timeout: int) -> bool:
-        """带超时控制的设备推送（供线程调用）"""
-        def push_task():
-            return self._push_device_data(device_id)
-        
-        # 使用线程实现超时控制
-        push_thread = threading.Thread(target=push_task, daemon=True)
-        push_thread.start()
-        push_thread.join(timeout=timeout)
+        # 数据与上次上报相同且未到强制上报间隔时跳过
+        params_hash = hash(frozenset(payload["params"].items()))
+        now = time.monotonic()
+        last = self._last_published.get(device_id)
+        if last and last[0] == params_hash and now - last[1] < self.max_publish_interval:
+            self.logger.info(f"设备 {device_id} 数据未变化，跳过推送")
+            return True
         
-        if push_thread.is_alive():
-            self.logger.error(f"设备 {device_id} 推送超时（超过{timeout}秒）")
+        self.logger.info(f"设备 {device_id} 准备推送数据: {payload['params'].keys()}")
+        if not self.mqtt_client.publish(device_config, payload):
             return False
+        self._last_published[device_id] = (params_hash, now)
         return True
 
     def start(self):
@@ -256,11 +372,13 @@ class HAto163Gateway:
         # 启动延迟（等待依赖服务就绪）
         startup_delay = self.config.get("startup_delay", 30)
         self.logger.info(f"启动延迟 {startup_delay} 秒...")
-        time.sleep(startup_delay)
+        if self._stop_event.wait(startup_delay):
+            return
 
         # 等待HA就绪
         if not self._wait_for_ha_ready():
-            self.logger.error("HA未就绪，服务启动失败")
+            if not self._stop_event.is_set():
+                self.logger.error("HA未就绪，服务启动失败")
             return
 
         # 连接MQTT broker
@@ -268,71 +386,108 @@ class HAto163Gateway:
             self.logger.error("MQTT连接失败，服务启动失败")
             return
 
+        # 订阅HA状态变化（失败时自动退回轮询）
+        if self.state_stream and not self.state_stream.start():
+            self.state_stream = None
+
         # 初始设备发现
         if not self._discover_devices():
             self.logger.error("未匹配到任何设备，服务启动失败")
             return
 
+        # 等待匹配到的实体就绪（一次性等待，未就绪的实体不阻塞启动）
+        self._wait_for_entities_ready()
+
+        # 推送线程池全程复用（任务数少于线程数时空闲线程不占资源）
+        self.executor = ThreadPoolExecutor(max_workers=16, thread_name_prefix="DevicePush")
+
         # 启动主循环
         self._run_loop()
         self.logger.info("服务已正常退出")
 
+    def _start_discovery(self):
+        """在后台线程执行定时设备发现；上一次发现尚未完成时跳过"""
+        if self._discovery_thread and self._discovery_thread.is_alive():
+            self.logger.warning("上一次设备发现尚未完成，跳过本次定时发现")
+            return
+        self.logger.info("执行定时设备发现...")
+        self._discovery_thread = threading.Thread(
+            target=self._discover_devices, name="HADiscovery", daemon=True
+        )
+        self._discovery_thread.start()
+
     def _run_loop(self):
         """服务主循环（定时发现设备和推送数据）"""
         push_interval = self.config.get("wy_push_interval", 60)
         discovery_interval = self.config.get("ha_discovery_interval", 300)
-        last_discovery = time.time()
-        last_push = time.time()
-        
-        # 初始化线程池（根据设备数量动态调整）
-        max_workers = min(len(self.matched_devices), 10) if self.matched_devices else 1
-        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="DevicePush")
+        # 单次推送的等待上限，留出余量保证不拖到下一个推送周期
+        push_budget = push_interval * 0.9
+        last_discovery = time.monotonic()
+        last_push = time.monotonic()
 
         while self.running:
-            now = time.time()
-
-            # 定时重新发现设备
-            if now - last_discovery >= discovery_interval:
-                self.logger.info("执行定时设备发现...")
-                self._discover_devices()
+            now = time.monotonic()
+            discovery_due = now - last_discovery >= discovery_interval
+            push_due = now - last_push >= push_interval
+
+            # 定时重新发现设备（后台执行，完成后原子替换匹配结果）
+            # 与推送同时到期时推迟到本周期快照获取之后启动，保证发现复用刚获取的快照
+            if discovery_due and not push_due:
+                self._start_discovery()
                 last_discovery = now
-                
-                # 动态调整线程池大小
-                new_max_workers = min(len(self.matched_devices), 10) if self.matched_devices else 1
-                if new_max_workers != max_workers:
-                    self.logger.info(f"线程池大小调整: {max_workers} → {new_max_workers}")
-                    self.executor.shutdown(wait=False)
-                    self.executor = ThreadPoolExecutor(max_workers=new_max_workers, thread_name_prefix="DevicePush")
-                    max_workers = new_max_workers
 
             # 定时异步推送数据
-            if now - last_push >= push_interval:
+            if push_due:
                 self.logger.info("开始异步数据推送...")
-                futures = []
-                
-                # 提交所有设备推送任务
-                for device_id in self.matched_devices:
-                    future = self.executor.submit(
-                        self._push_device_with_timeout,
-                        device_id,
-                        timeout=60  # 单个设备推送超时
-                    )
-                    futures.append((device_id, future))
-
-                # 处理推送结果
-                for device_id, future in futures:
-                    try:
-                        result = future.result(timeout=65)  # 等待结果超时（略长于单个设备超时）
-                        if result:
-                            self.logger.info(f"设备 {device_id} 异步推送完成")
-                        else:
-                            self.logger.warning(f"设备 {device_id} 异步推送无有效数据")
-                    except Exception as e:
-                        self.logger.error(f"设备 {device_id} 异步推送异常: {str(e)}")
+
+                # 每个周期只获取一次全部实体状态，各设备从快照中取值
+                states = self._current_states()
+                if discovery_due:
+                    self._start_discovery()
+                    last_discovery = now
+                if not states:
+                    self.logger.warning("未获取到HA状态快照，跳过本次推送")
+                    fut_to_id = {}
+                else:
+                    matched_devices = self.matched_devices
+                    # 快照中缺失的实体（如快照之后新增的实体）去重后单独请求，每周期每个实体最多一次
+                    for entity_id in self._required_entities(matched_devices) - states.keys():
+                        states[entity_id] = self._fetch_entity_state(entity_id)
+
+                    # 提交所有设备推送任务（HTTP/MQTT操作自带超时，外层由 as_completed 的超时兜底）
+                    # 每个任务只拿到自己设备的数据；后台发现整体替换匹配结果，推送中途不受影响
+                    # 各设备错开提交，分散在推送周期的前半段，避免上报集中在同一时刻
+                    stagger = min(push_interval * 0.5 / max(1, len(matched_devices)), 1.0)
+                    fut_to_id = {}
+                    for i, (device_id, device_data) in enumerate(matched_devices.items()):
+                        if i and self._stop_event.wait(stagger):
+                            break
+                        future = self.executor.submit(self._push_device_data, device_id, device_data, states)
+                        fut_to_id[future] = device_id
+
+                # 按完成顺序处理推送结果，慢设备不阻塞其它设备的结果处理
+                try:
+                    # 等待上限从本周期开始计算（包含错开提交所用的时间）
+                    remaining = max(0, now + push_budget - time.monotonic())
+                    for future in as_completed(fut_to_id, timeout=remaining):
+                        device_id = fut_to_id[future]
+                        try:
+                            if future.result():
+                                self.logger.info(f"设备 {device_id} 异步推送完成")
+                            else:
+                                self.logger.warning(f"设备 {device_id} 异步推送无有效数据")
+                        except Exception as e:
+                            self.logger.error(f"设备 {device_id} 异步推送异常: {str(e)}")
+                except FuturesTimeoutError:
+                    pending = [device_id for future, device_id in fut_to_id.items() if not future.done()]
+                    self.logger.error(f"设备 {pending} 推送超时（超过{push_budget:.0f}秒）")
 
                 last_push = now
 
-            time.sleep(1)  # 降低CPU占用
+            # 休眠到下一次定时任务，收到停止信号时立即醒来退出
+            next_deadline = min(last_push + push_interval, last_discovery + discovery_interval)
+            if self._stop_event.wait(max(0, next_deadline - time.monotonic())):
+                break
 
 
 if __name__ == "__main__":
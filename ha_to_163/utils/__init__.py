@@ -1,4 +1,5 @@
 # 导出工具类
 from .config_loader import ConfigLoader
 from .mqtt_client import MQTTClient
+from .ha_websocket import HAStateStream
     
\ No newline at end of file
@@ -0,0 +1,168 @@
+import json
+import logging
+import threading
+from typing import Dict, Iterable, Optional
+
+
+class HAStateStream:
+    """通过HA WebSocket API订阅指定实体（subscribe_entities），在本地维护实体状态缓存
+    只订阅设备发现匹配到的实体，订阅后HA先推送这些实体的当前状态，之后只推送它们的变化，
+    推送周期无需再轮询HA；未设置订阅实体前不建立连接
+    """
+
+    # 重连退避上限（秒）
+    MAX_RECONNECT_DELAY = 60
+    # 连续多久没有收到消息就发送一次心跳（秒）
+    PING_INTERVAL = 30
+
+    def __init__(self, ha_url: str, ha_token: str):
+        # http(s)://host:8123 → ws(s)://host:8123/api/websocket
+        self.ws_url = "ws" + ha_url.rstrip("/")[len("http"):] + "/api/websocket"
+        self.ha_token = ha_token
+        self.logger = logging.getLogger("ha_websocket")
+        self._states: Dict[str, Optional[str]] = {}
+        self._ready = threading.Event()  # 已完成首次get_states，缓存可用
+        self._stop_event = threading.Event()
+        self._thread: threading.Thread = None
+        self._ws = None
+        self._msg_id = 0
+        self._entity_ids = frozenset()  # 当前订阅的实体ID
+        self._entities_changed = threading.Event()  # 订阅实体有变化（或停止），唤醒连接循环
+
+    def start(self) -> bool:
+        """启动后台订阅线程；未安装websocket-client时返回False（调用方退回轮询）"""
+        try:
+            import websocket  # noqa: F401
+        except ImportError:
+            self.logger.warning("未安装websocket-client，实体状态将通过轮询获取")
+            return False
+
+        self._stop_event.clear()
+        self._thread = threading.Thread(target=self._run, name="HAWebSocket", daemon=True)
+        self._thread.start()
+        return True
+
+    def stop(self):
+        """停止订阅并关闭连接"""
+        self._stop_event.set()
+        self._entities_changed.set()
+        ws = self._ws
+        if ws:
+            try:
+                ws.close()
+            except Exception as e:
+                self.logger.debug(f"关闭WebSocket时出现异常（可忽略）: {e}")
+
+    def set_entities(self, entity_ids: Iterable[str]):
+        """设置需要订阅的实体；集合变化时断开当前连接，按新的实体列表重新订阅"""
+        entity_ids = frozenset(entity_ids)
+        if entity_ids == self._entity_ids:
+            return
+        self._entity_ids = entity_ids
+        self._entities_changed.set()
+        ws = self._ws
+        if ws:
+            self.logger.info(f"订阅实体已变化（共 {len(entity_ids)} 个），重新建立订阅")
+            try:
+                ws.close()
+            except Exception as e:
+                self.logger.debug(f"关闭WebSocket时出现异常（可忽略）: {e}")
+
+    def snapshot(self) -> Dict[str, Optional[str]]:
+        """返回当前状态缓存的副本；连接未就绪时返回空字典"""
+        if not self._ready.is_set():
+            return {}
+        return self._states.copy()
+
+    def _next_id(self) -> int:
+        self._msg_id += 1
+        return self._msg_id
+
+    def _run(self):
+        """连接循环：断开后按指数退避重连"""
+        delay = 1
+        while not self._stop_event.is_set():
+            # 尚无订阅实体（设备发现未完成）时不连接，避免订阅全部实体
+            if not self._entity_ids:
+                self._entities_changed.wait()
+                self._entities_changed.clear()
+                continue
+            self._entities_changed.clear()
+            try:
+                self._session()
+            except Exception as e:
+                if self._stop_event.is_set():
+                    break
+                if self._entities_changed.is_set():
+                    # 订阅实体变化导致的主动断开，立即按新列表重连
+                    self._ready.clear()
+                    delay = 1
+                    continue
+                if self._ready.is_set():
+                    delay = 1  # 上次会话曾正常工作，退避从头开始
+                self.logger.warning(f"HA WebSocket连接中断: {e}，{delay}秒后重连")
+            self._ready.clear()
+            if self._stop_event.wait(delay):
+                break
+            delay = min(delay * 2, self.MAX_RECONNECT_DELAY)
+
+    def _session(self):
+        """建立一次WebSocket会话：认证、订阅实体，然后持续处理状态推送"""
+        import websocket
+
+        ws = websocket.create_connection(self.ws_url, timeout=10)
+        self._ws = ws
+        self._msg_id = 0
+        try:
+            # 认证流程：auth_required → auth → auth_ok
+            json.loads(ws.recv())
+            ws.send(json.dumps({"type": "auth", "access_token": self.ha_token}))
+            msg = json.loads(ws.recv())
+            if msg.get("type") != "auth_ok":
+                raise RuntimeError(f"认证失败: {msg.get('message', msg.get('type'))}")
+
+            # 只订阅匹配到的实体：首个事件为这些实体的当前状态，之后只推送它们的变化
+            entity_ids = self._entity_ids
+            subscribe_id = self._next_id()
+            ws.send(json.dumps({"id": subscribe_id, "type": "subscribe_entities", "entity_ids": sorted(entity_ids)}))
+            self.logger.info(f"HA WebSocket已连接: {self.ws_url}，订阅 {len(entity_ids)} 个实体")
+
+            ws.settimeout(self.PING_INTERVAL)
+            ping_pending = False
+            while not self._stop_event.is_set():
+                try:
+                    raw = ws.recv()
+                except websocket.WebSocketTimeoutException:
+                    # 长时间无消息：发送心跳，连续两次无响应视为连接失效
+                    if ping_pending:
+                        raise RuntimeError("心跳超时")
+                    ws.send(json.dumps({"id": self._next_id(), "type": "ping"}))
+                    ping_pending = True
+                    continue
+                ping_pending = False
+                if not raw:
+                    raise RuntimeError("连接已被HA关闭")
+
+                msg = json.loads(raw)
+                msg_type = msg.get("type")
+                if msg_type == "event" and msg.get("id") == subscribe_id:
+                    # 压缩格式：a=新增实体完整状态，c=状态差异（+ 中的 s 为新状态），r=已删除实体
+                    event = msg["event"]
+                    added = {entity_id: s.get("s") for entity_id, s in event.get("a", {}).items()}
+                    if not self._ready.is_set():
+                        self._states = added
+                        self._ready.set()
+                        self.logger.info(f"HA WebSocket状态缓存已就绪，共 {len(self._states)} 个实体")
+                    else:
+                        self._states.update(added)
+                    for entity_id, diff in event.get("c", {}).items():
+                        changed = diff.get("+", {})
+                        if "s" in changed:
+                            self._states[entity_id] = changed["s"]
+                    for entity_id in event.get("r", ()):
+                        self._states.pop(entity_id, None)
+                elif msg_type == "result" and msg.get("id") == subscribe_id and not msg.get("success"):
+                    raise RuntimeError(f"订阅实体失败: {msg.get('error')}")
+        finally:
+            self._ws = None
+            ws.close()
@@ -6,7 +6,18 @@ import hashlib
 import json
 import requests
 import threading
-from typing import Dict, Any
+from typing import Dict, Any, Optional
+from device_discovery.ha_discovery import switch_state_rank
+
+# 可选使用orjson序列化上报数据（直接得到bytes，paho无需再编码），未安装时使用标准库json
+try:
+    import orjson
+
+    def _dumps(obj) -> bytes:
+        return orjson.dumps(obj)
+except ImportError:
+    def _dumps(obj) -> bytes:
+        return json.dumps(obj).encode("utf-8")
 
 
 class MQTTClient:
@@ -16,8 +27,10 @@ class MQTTClient:
     
     # 最大连接失败次数，超过后触发程序重启
     MAX_CONNECT_FAILURES = 10
+    # QoS1消息的在途窗口（同一周期内各设备的上报连续发出，不必逐条等待PUBACK）
+    MAX_INFLIGHT_MESSAGES = 64
     
-    def __init__(self, config: Dict[str, Any]):
+    def __init__(self, config: Dict[str, Any], session: Optional[requests.Session] = None):
         self.config = config
         self.logger = logging.getLogger("mqtt_client")
         self.client: mqtt.Client = None
@@ -34,6 +47,15 @@ class MQTTClient:
             "Authorization": f"Bearer {self.config['ha_token']}",
             "Content-Type": "application/json"
         }
+        # HA请求会话（优先复用网关共享的连接池，未传入时自建）
+        self.session = session if session is not None else requests.Session()
+        # 子设备属性上报Topic缓存（设备配置固定，每个设备只拼接一次）
+        self._post_topics: Dict[str, str] = {}
+    
+    @staticmethod
+    def _post_topic(device: dict) -> str:
+        """子设备属性上报Topic"""
+        return f"sys/{device['product_key']}/{device['device_name']}/event/property/post"
     
     def set_restart_callback(self, callback):
         """设置重启回调函数，当连接失败次数超过阈值时调用"""
@@ -52,6 +74,7 @@ class MQTTClient:
             
             self.client = mqtt.Client(client_id=client_id, clean_session=True, protocol=mqtt.MQTTv311)
             self.client.username_pw_set(username=username, password=password)
+            self.client.max_inflight_messages_set(self.MAX_INFLIGHT_MESSAGES)
             
             if self.config.get("use_ssl", False):
                 self.client.tls_set()
@@ -121,8 +144,8 @@ class MQTTClient:
             self.client.loop_start()  # 启动网络循环线程
             
             # 等待连接成功（超时15秒）
-            start_time = time.time()
-            while not self.connected and (time.time() - start_time) < 15:
+            start_time = time.monotonic()
+            while not self.connected and (time.monotonic() - start_time) < 15:
                 time.sleep(0.1)
             
             return self.connected
@@ -286,8 +309,8 @@ class MQTTClient:
                 self.client.loop_start()
                 
                 # 等待连接成功
-                start_time = time.time()
-                while not self.connected and (time.time() - start_time) < 15:
+                start_time = time.monotonic()
+                while not self.connected and (time.monotonic() - start_time) < 15:
                     if self._stop_flag:
                         return
                     time.sleep(0.5)
@@ -392,7 +415,7 @@ class MQTTClient:
         matched_entity = None
         try:
             # 查询HA中的实体列表
-            resp = requests.get(
+            resp = self.session.get(
                 f"{self.config['ha_url']}/api/states",
                 headers=self.ha_headers,
                 timeout=10
@@ -408,14 +431,31 @@ class MQTTClient:
             entities = resp.json()
             # 筛选符合前缀且类型为switch的实体（修复实体类型匹配问题）
             target_entity_type = "switch"
-            candidate_entities = [
+            domain_prefix = f"{target_entity_type}."
+            switch_entities = [
                 e["entity_id"] for e in entities
-                if entity_prefix in e["entity_id"] 
-                and e["entity_id"].startswith(f"{target_entity_type}.")
+                if e["entity_id"].startswith(domain_prefix)
             ]
-
-            if candidate_entities:
-                matched_entity = candidate_entities[0]
+            # 与设备发现规则一致（switch_state_rank）：优先与前缀完全一致的开关实体（如 switch.plug_01），
+            # 其次以前缀开头且后缀含开关关键词的实体（如 switch.plug_01_switch_p_2_1），
+            # 最后按包含关系宽松匹配（兼容配置中带域名的写法和旧配置）
+            core_prefix = entity_prefix.split(".", 1)[1] if "." in entity_prefix else entity_prefix
+            best_rank = None
+            for entity_id in switch_entities:
+                core = entity_id[len(domain_prefix):]
+                if core.startswith(core_prefix):
+                    rank = switch_state_rank(core[len(core_prefix):].strip("_"), anchored=True)
+                elif core_prefix in core:
+                    rank = switch_state_rank("", anchored=False)
+                else:
+                    continue
+                # 同优先级保留最先出现的实体
+                if best_rank is None or rank < best_rank:
+                    best_rank = rank
+                    matched_entity = entity_id
+                    if rank == 0:
+                        break
+            if matched_entity:
                 self.logger.info(f"匹配到控制实体: {matched_entity}")
             else:
                 self.logger.error(f"未找到前缀为'{entity_prefix}'的{target_entity_type}类型实体")
@@ -435,7 +475,7 @@ class MQTTClient:
 
         try:
             # 发送控制指令到HA
-            response = requests.post(
+            response = self.session.post(
                 f"{self.config['ha_url']}/api/services/switch/turn_{ha_state}",
                 headers=self.ha_headers,
                 json={"entity_id": matched_entity},
@@ -477,9 +517,10 @@ class MQTTClient:
         
         try:
             if self.connected:
-                result = self.client.publish(reply_topic, json.dumps(reply_payload), qos=1)
+                data = json.dumps(reply_payload)
+                result = self.client.publish(reply_topic, data, qos=1)
                 if result.rc == mqtt.MQTT_ERR_SUCCESS:
-                    self.logger.info(f"回复成功: {reply_topic} → {json.dumps(reply_payload)}")
+                    self.logger.info(f"回复成功: {reply_topic} → {data}")
                 else:
                     self.logger.error(f"回复失败（MQTT错误码: {result.rc}）: {reply_topic}")
             else:
@@ -490,7 +531,6 @@ class MQTTClient:
     def _report_state(self, device: dict, state: int):
         """控制后主动上报设备状态"""
         try:
-            topic = f"sys/{device['product_key']}/{device['device_name']}/event/property/post"
             payload = {
                 "id": int(time.time() * 1000),
                 "version": "1.0",
@@ -507,11 +547,15 @@ class MQTTClient:
                 self.logger.error("MQTT未连接，发布失败")
                 return False
             
-            topic = f"sys/{device['product_key']}/{device['device_name']}/event/property/post"
-            result = self.client.publish(topic, json.dumps(payload), qos=1)
+            topic = self._post_topics.get(device.get("id"))
+            if topic is None:
+                topic = self._post_topics[device.get("id")] = self._post_topic(device)
+            # 只序列化一次，发布和日志共用
+            data = _dumps(payload)
+            result = self.client.publish(topic, data, qos=1)
             
             if result.rc == mqtt.MQTT_ERR_SUCCESS:
-                self.logger.info(f"数据发布成功: {topic} → {json.dumps(payload)}")
+                self.logger.info("数据发布成功: %s → %s", topic, data.decode("utf-8"))
                 return True
             else:
                 self.logger.error(f"数据发布失败（MQTT错误码: {result.rc}）: {topic}")